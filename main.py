@@ -1,31 +1,102 @@
 import os
 import time
-import uuid
-import json
+import itertools
+import base64
+import random
 import asyncio
 import aiohttp
 import aiofiles
+import aiofiles.os
+import orjson
 from io import BytesIO
-from typing import Union, List, Tuple
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Tuple, Optional, Set, Dict, FrozenSet, NamedTuple
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 from pathlib import Path 
 from PIL import Image as PILImage 
+from cachetools import TTLCache
+
+try:
+    from turbojpeg import TurboJPEG
+except ImportError:
+    TurboJPEG = None
 
 from astrbot.api.message_components import Image, Plain
 from astrbot.api.event import filter, AstrMessageEvent, MessageChain
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger 
 
+# 预先解析好的图源配置，避免每条消息都重新读取、清洗配置字典
+class _CompiledSource(NamedTuple):
+    name: str
+    keywords: Tuple[str, ...]
+    apis: Tuple[str, ...]
+    use_forward: bool
+    list_mode: str
+    group_list: FrozenSet[str]
+    recall_delay: int
+    coalesce: bool
+
 @register("mccloud_img", "随机图片", "支持批量获取、API轮询、重新抽卡防拦截、双重撤回与直链兜底。", "5.9.0")
 class SetuPlugin(Star):
+    _URL_KEYS = ("original", "url_original", "url", "img", "image", "src", "link")
+    # 同一 API 连续失败达到次数后熔断一段时间（秒）
+    _BREAKER_THRESHOLD = 3
+    _BREAKER_COOLDOWN = 60
+
     def __init__(self, context: Context, config: dict):
         super().__init__(context)
         self.cfg = config 
         
-        self.cooldowns = {}
+        # TTLCache 基于 time.monotonic，条目到期自动淘汰，不会随用户数无限增长
+        self.cooldowns = TTLCache(maxsize=10000, ttl=max(0, self.cfg.get("cooldown", 10)))
+        self._sources = self._compile_sources()
+        self._keyword_table = self._build_keyword_table()
+        # 以解析出的真实图片直链为键缓存压缩后的图片，按字节数限制总大小，并在有效期后自动过期
+        self._image_cache = TTLCache(
+            maxsize=max(0, self.cfg.get("image_cache_mb", 64)) * 1024 * 1024,
+            ttl=max(0, self.cfg.get("image_cache_ttl", 600)),
+            getsizeof=len,
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._fetch_sem = asyncio.Semaphore(max(1, int(self.cfg.get("max_concurrency", 8))))
+        self._tj = None
+        if TurboJPEG is not None:
+            try: self._tj = TurboJPEG()
+            except Exception as e: logger.warning(f"[随机图片] libjpeg-turbo 加载失败，将使用 Pillow 压缩: {e}")
+        # 压缩属于 CPU 密集操作，放到独立线程池执行，避免阻塞事件循环
+        self._pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="endworld_img")
+        self._pending: Set[asyncio.Task] = set()
+        self._breaker: Dict[str, Tuple[int, float]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
         self.cache_dir = os.path.join(os.getcwd(), "data", "temp_images")
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir, exist_ok=True)
+        # 进程号 + 加载时间作前缀，配合自增计数生成不重复的临时文件名；插件重载后前缀也会变化
+        self._file_prefix = f"{os.getpid()}-{time.time_ns():x}"
+        self._file_counter = itertools.count()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # 整个插件生命周期复用同一个会话，避免每条指令都重新握手
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                # ssl=None 表示使用默认的证书校验；aiohttp 3.8 会把 ssl=True 当作不校验
+                ssl=None if self.cfg.get("verify_ssl", True) else False,
+                limit=64,
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def terminate(self):
+        # 取消挂起的延迟删除任务，任务会在退出前立即清理对应的临时文件
+        for task in list(self._pending): task.cancel()
+        if self._pending: await asyncio.gather(*self._pending, return_exceptions=True)
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._pool.shutdown(wait=False)
 
     def _text(self, base_text: str) -> str:
         if self.cfg.get("catgirl_enable", False):
@@ -33,20 +104,56 @@ class SetuPlugin(Star):
             return f"{base_text}{suffix}"
         return base_text
 
-    def _clean_cooldowns(self):
-        now = time.time()
-        cooldown_time = self.cfg.get("cooldown", 10)
-        self.cooldowns = {uid: t for uid, t in self.cooldowns.items() if now - t < cooldown_time}
+    # AstrBot 保存配置后会重载插件，因此图源与触发词表只需在初始化时构建一次
+    def _compile_sources(self) -> Tuple[_CompiledSource, ...]:
+        compiled = []
+        for source in self.cfg.get("sources", []):
+            if not isinstance(source, dict): continue
+            keywords = (str(kw).strip() for kw in source.get("keywords", []))
+            apis = (str(api).strip() for api in source.get("apis", []))
+            compiled.append(_CompiledSource(
+                name=str(source.get("name", "")),
+                keywords=tuple(kw for kw in keywords if kw),
+                apis=tuple(dict.fromkeys(api for api in apis if api)),
+                use_forward=bool(source.get("use_forward", False)),
+                list_mode=source.get("list_mode", "无限制"),
+                group_list=frozenset(str(x) for x in source.get("group_list", []) if x),
+                recall_delay=int(source.get("recall_delay") or 0),
+                coalesce=bool(source.get("coalesce_requests", False)),
+            ))
+        return tuple(compiled)
+
+    # 触发词 -> (优先级, 图源)
+    def _build_keyword_table(self) -> Dict[str, Tuple[int, _CompiledSource]]:
+        table = {}
+        order = 0
+        for source in self._sources:
+            for kw in source.keywords:
+                if kw not in table: table[kw] = (order, source)
+                order += 1
+        return table
+
+    # 消息只可能是「触发词」或「触发词 + 空格 + 数字」，最多查两次表即可，按配置顺序取优先者
+    def _match_keyword(self, msg_text: str) -> Tuple[Optional[_CompiledSource], int]:
+        best = None
+        exact = self._keyword_table.get(msg_text)
+        if exact: best = (exact[0], exact[1], 1)
+
+        i = len(msg_text)
+        while i > 0 and msg_text[i - 1].isdecimal(): i -= 1
+        kw = msg_text[:i].rstrip()
+        if kw and i < len(msg_text) and msg_text[len(kw)] == " ":
+            prefixed = self._keyword_table.get(kw)
+            if prefixed and (best is None or prefixed[0] < best[0]):
+                best = (prefixed[0], prefixed[1], int(msg_text[i:]))
+
+        if best is None: return None, 1
+        return best[1], best[2]
 
     def _check_cooldown(self, user_id: str) -> float:
-        self._clean_cooldowns()
-        current_time = time.time()
-        cooldown_time = self.cfg.get("cooldown", 10)
-        if user_id in self.cooldowns:
-            elapsed = current_time - self.cooldowns[user_id]
-            if elapsed < cooldown_time:
-                return cooldown_time - elapsed
-        return 0
+        last_time = self.cooldowns.get(user_id)
+        if last_time is None: return 0
+        return max(0, self.cooldowns.ttl - (time.monotonic() - last_time))
 
     def _is_safe_url(self, url: str) -> bool:
         try:
@@ -61,42 +168,79 @@ class SetuPlugin(Star):
         except Exception:
             return False
 
+    # 显式栈代替递归；子节点逆序入栈，保持原有深度优先的查找顺序
     def _extract_url_from_json(self, data: Union[dict, list]) -> str:
-        if isinstance(data, list):
-            for item in data:
-                res = self._extract_url_from_json(item)
-                if res: return res
-        elif isinstance(data, dict):
-            for key in ["original", "url_original", "url", "img", "image", "src", "link"]:
-                if key in data and isinstance(data[key], str) and data[key].startswith("http"):
-                    return data[key]
-            for value in data.values():
-                res = self._extract_url_from_json(value)
-                if res: return res
+        stack = [data]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                for key in self._URL_KEYS:
+                    value = node.get(key)
+                    if isinstance(value, str) and value.startswith("http"): return value
+                stack.extend(reversed(node.values()))
+            elif isinstance(node, list):
+                stack.extend(reversed(node))
+        return ""
+
+    # 根据文件头识别图片格式，无法识别时返回空字符串
+    @staticmethod
+    def _sniff_ext(data: bytes) -> str:
+        if data[:3] == b'\xff\xd8\xff': return "jpg"
+        if data[:8] == b'\x89PNG\r\n\x1a\n': return "png"
+        if data[:6] in (b'GIF87a', b'GIF89a'): return "gif"
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP': return "webp"
+        if data[4:12] in (b'ftypavif', b'ftypavis'): return "avif"
+        if data[:2] == b'\xff\x0a' or data[:12] == b'\x00\x00\x00\x0cJXL \r\n\x87\n': return "jxl"
         return ""
 
     def _compress_image(self, image_data: bytes) -> bytes:
         if not self.cfg.get("compress_enable", True): return image_data
-        threshold_mb = self.cfg.get("compress_threshold", 5)
-        if len(image_data) <= threshold_mb * 1024 * 1024: return image_data
+        threshold_bytes = self.cfg.get("compress_threshold", 5) * 1024 * 1024
+        if len(image_data) <= threshold_bytes: return image_data
+        # 只压缩 JPEG/PNG/静态 WebP；GIF 与动态 WebP 重新编码会丢失动画
+        image_ext = self._sniff_ext(image_data)
+        if image_ext not in ("jpg", "png", "webp"): return image_data
+        is_jpeg = image_ext == "jpg"
+        # 仅略超阈值的 JPEG 本身已是有损压缩，重新编码收益很小，直接原样返回
+        if is_jpeg and len(image_data) < threshold_bytes * 1.5: return image_data
+        quality = self.cfg.get("compress_quality", 85)
+        # 远超阈值的 JPEG 在 DCT 阶段直接按 1/2、1/4 缩小解码，解码更快，输出也更小
+        scale = 1
+        if is_jpeg and len(image_data) >= threshold_bytes * 2:
+            scale = 2 if len(image_data) < threshold_bytes * 4 else 4
+        # JPEG 优先交给 libjpeg-turbo 直接重新量化，省去 RGB 解码往返
+        if self._tj is not None and is_jpeg:
+            try: return self._tj.scale_with_quality(image_data, scaling_factor=(1, scale) if scale > 1 else None, quality=quality)
+            except Exception: pass
         try:
             img = PILImage.open(BytesIO(image_data))
+            if getattr(img, "is_animated", False): return image_data
+            # draft 必须在图片真正解码前调用
+            if scale > 1: img.draft('RGB', (img.width // scale, img.height // scale))
             if img.mode != 'RGB': img = img.convert('RGB')
-            quality = self.cfg.get("compress_quality", 85)
             output_buffer = BytesIO()
-            img.save(output_buffer, format='JPEG', quality=quality)
+            img.save(output_buffer, format='JPEG', quality=quality, optimize=False, progressive=False)
             return output_buffer.getvalue()
         except Exception:
             return image_data 
 
-    async def _safe_fetch(self, session: aiohttp.ClientSession, url: str, max_size_mb: int = 20) -> Tuple[bytes, str, str]:
+    # 去掉 _safe_fetch 追加的 _t 防缓存参数，得到可展示、可比较的地址
+    @staticmethod
+    def _strip_cache_buster(url: str) -> str:
+        parsed = urlparse(url)
+        query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if k != "_t"]
+        return urlunparse(parsed._replace(query=urlencode(query)))
+
+    async def _safe_fetch(self, session: aiohttp.ClientSession, url: str, max_size_mb: Optional[int] = None) -> Tuple[bytes, str, str]:
         if not self._is_safe_url(url): return b"", "", url
+        if max_size_mb is None: max_size_mb = self.cfg.get("max_download_mb", 20)
         
         separator = "&" if "?" in url else "?"
         no_cache_url = f"{url}{separator}_t={int(time.time() * 1000)}"
         
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+            "Accept": "image/jpeg,image/webp;q=0.9,image/png;q=0.8,*/*;q=0.5",
             "Cache-Control": "no-cache",
             "Pragma": "no-cache"
         }
@@ -105,15 +249,24 @@ class SetuPlugin(Star):
             async with session.get(no_cache_url, headers=headers, allow_redirects=True, timeout=20) as response:
                 if response.status != 200: return b"", "", url
                 content_type = response.headers.get("Content-Type", "").lower()
-                final_url = str(response.url)
-                body = b""
+                final_url = self._strip_cache_buster(str(response.url))
                 max_bytes = max_size_mb * 1024 * 1024
-                while True:
-                    chunk = await response.content.read(8192)
-                    if not chunk: break
+                # 响应头已声明超出上限时直接放弃，不再下载正文
+                if response.content_length and response.content_length > max_bytes:
+                    logger.warning(f"[随机图片] 图片大小 {response.content_length} 字节超过下载上限，已跳过: {final_url}")
+                    return b"", "", final_url
+                # bytearray 原地追加，避免 bytes 拼接在每个分块上整体复制
+                body = bytearray()
+                # 文本响应通常只是一条直链，先读开头 2KB 判断，不必下载整个错误页面；文件头是图片时才继续读完
+                if "text" in content_type:
+                    try: head = await response.content.readexactly(2048)
+                    except asyncio.IncompleteReadError as e: head = e.partial
+                    if not self._sniff_ext(head): return head, content_type, final_url
+                    body += head
+                async for chunk in response.content.iter_chunked(65536):
                     body += chunk
                     if len(body) > max_bytes: return b"", "", final_url
-                return body, content_type, final_url
+                return bytes(body), content_type, final_url
         except Exception: pass
         return b"", "", url
 
@@ -164,40 +317,17 @@ class SetuPlugin(Star):
     @filter.event_message_type(filter.EventMessageType.ALL)
     async def on_message(self, event: AstrMessageEvent):
         msg_text = event.message_str.strip()
-        sources = self.cfg.get("sources", [])
-        matched_source = None
-        is_matched = False
-        count = 1
 
         # 匹配触发词并提取后面的数字
-        for source in sources:
-            if not isinstance(source, dict): continue
-            keywords = source.get("keywords", [])
-            for kw in keywords:
-                kw = str(kw).strip()
-                if not kw: continue
-                if msg_text == kw:
-                    matched_source = source
-                    is_matched = True
-                    break
-                elif msg_text.startswith(kw + " "):
-                    rest = msg_text[len(kw):].strip()
-                    if rest.isdigit():
-                        count = int(rest)
-                        matched_source = source
-                        is_matched = True
-                        break
-            if is_matched: break
-        
-        if not is_matched or not matched_source: return 
+        matched_source, count = self._match_keyword(msg_text)
+        if not matched_source: return 
 
         group_id = getattr(event.message_obj, "group_id", None)
         if group_id:
             group_id_str = str(group_id)
-            list_mode = matched_source.get("list_mode", "无限制")
-            group_list = [str(x) for x in matched_source.get("group_list", []) if x]
-            if list_mode == "白名单" and group_id_str not in group_list: return 
-            elif list_mode == "黑名单" and group_id_str in group_list: return 
+            list_mode = matched_source.list_mode
+            if list_mode == "白名单" and group_id_str not in matched_source.group_list: return 
+            elif list_mode == "黑名单" and group_id_str in matched_source.group_list: return 
 
         event.stop_event()
 
@@ -207,9 +337,8 @@ class SetuPlugin(Star):
             yield event.plain_result(self._text(f"冲太快了！请休息 {int(remaining)} 秒再试"))
             return
         
-        target_apis = matched_source.get("apis", [])
-        if not target_apis:
-            yield event.plain_result(self._text(f"图源 [{matched_source.get('name')}] 未配置 API 地址"))
+        if not matched_source.apis:
+            yield event.plain_result(self._text(f"图源 [{matched_source.name}] 未配置 API 地址"))
             return
 
         # 校验请求数量
@@ -221,156 +350,263 @@ class SetuPlugin(Star):
             count = 1
 
         # 结合全局设置与图源独立设置判断是否使用合并转发
-        source_use_forward = matched_source.get("use_forward", False)
+        source_use_forward = matched_source.use_forward
         force_forward = self.cfg.get("batch_force_forward", False)
         threshold = self.cfg.get("batch_forward_threshold", 3)
         final_use_forward = source_use_forward or force_forward or (count >= threshold)
 
-        success = await self._process_and_send(event, target_apis, matched_source, count, final_use_forward)
-        if success: self.cooldowns[user_id] = time.time()
+        success = await self._process_and_send(event, matched_source, count, final_use_forward)
+        if success: self.cooldowns[user_id] = time.monotonic()
 
-    # 抽取核心的下载流程，专门用于多次调用
-    async def _download_image(self, session: aiohttp.ClientSession, api_list: List[str]) -> Tuple[str, str]:
-        for api_url in api_list:
-            api_url = str(api_url).strip()
-            if not api_url: continue
-            try:
-                body, ctype, final_url = await self._safe_fetch(session, api_url)
-                if not body: continue
+    def _has_available_api(self, source: _CompiledSource) -> bool:
+        now = time.monotonic()
+        return any(self._breaker.get(url, (0, 0.0))[1] <= now for url in source.apis)
 
-                if "application/json" in ctype:
-                    try:
-                        data = json.loads(body.decode('utf-8'))
-                        real_img_url = self._extract_url_from_json(data)
-                        if real_img_url:
-                            body, ctype, final_url = await self._safe_fetch(session, real_img_url)
-                    except Exception: pass
-                        
-                if not body: continue
-
-                if "text" in ctype and len(body) < 2000 and body.startswith(b"http"):
-                    real_url = body.decode('utf-8').strip()
-                    body, ctype, final_url = await self._safe_fetch(session, real_url)
-                
-                if not body: continue
-
-                body = self._compress_image(body)
-                file_ext = "jpg" 
-                if body[0:4] == b'\x89PNG': file_ext = "png"
-                elif body[0:3] == b'GIF': file_ext = "gif"
-                
-                filename = f"{uuid.uuid4()}.{file_ext}"
-                temp_file_path = os.path.join(self.cache_dir, filename)
-
-                async with aiofiles.open(temp_file_path, "wb") as f:
-                    await f.write(body)
-
-                return temp_file_path, final_url
+    # 指数退避并加入随机抖动
+    async def _backoff(self, attempt: int):
+        await asyncio.sleep(min(8, 0.5 * (2 ** attempt)) * (0.5 + random.random()))
+
+    def _record_failure(self, api_url: str):
+        fails = self._breaker.get(api_url, (0, 0.0))[0] + 1
+        open_until = time.monotonic() + self._BREAKER_COOLDOWN if fails >= self._BREAKER_THRESHOLD else 0.0
+        self._breaker[api_url] = (fails, open_until)
+
+    # 单个 API 的获取流程，并记录熔断状态；被取消的请求不计为失败
+    async def _fetch_one(self, session: aiohttp.ClientSession, api_url: str) -> Optional[Tuple[bytes, str]]:
+        async with self._fetch_sem:
+            result = await self._resolve_image(session, api_url)
+        if result: self._breaker.pop(api_url, None)
+        else: self._record_failure(api_url)
+        return result
+
+    # 单个 API 的完整获取流程：请求、JSON/文本寻址与压缩
+    async def _resolve_image(self, session: aiohttp.ClientSession, api_url: str) -> Optional[Tuple[bytes, str]]:
+        try:
+            body, ctype, final_url = await self._safe_fetch(session, api_url)
+            if not body: return None
+
+            # 只缓存 API 返回的直链，API 地址本身每次都是随机图，不能缓存；
+            # 直链发生了跳转说明它可能仍是随机入口，同样不缓存
+            cache_key = ""
+            if "application/json" in ctype:
+                try:
+                    data = orjson.loads(body)
+                    real_img_url = self._extract_url_from_json(data)
+                    if real_img_url:
+                        cache_key = real_img_url
+                        cached = self._image_cache.get(cache_key)
+                        if cached: return cached, cache_key
+                        body, ctype, final_url = await self._safe_fetch(session, real_img_url)
+                except Exception: pass
+
+            if not body: return None
+
+            if "text" in ctype and not self._sniff_ext(body):
+                text = body.decode('utf-8', 'ignore').strip()
+                if not text.startswith("http"): return None
+                real_url = text.split("\n", 1)[0].strip()
+                cache_key = real_url
+                cached = self._image_cache.get(cache_key)
+                if cached: return cached, cache_key
+                body, ctype, final_url = await self._safe_fetch(session, real_url)
+
+            if not body: return None
+
+            body = await asyncio.get_running_loop().run_in_executor(self._pool, self._compress_image, body)
+            if cache_key and final_url == cache_key and len(body) <= self._image_cache.maxsize:
+                self._image_cache[cache_key] = body
+            return body, final_url
+        except Exception as e:
+            logger.error(f"[随机图片] 处理图源时出现异常: {e}")
+        return None
+
+    # 同一地址的并发请求共享一次下载，仅适用于返回结果固定的 API；shield 保证单个等待方被取消时不影响其他等待方
+    async def _fetch_shared(self, session: aiohttp.ClientSession, api_url: str) -> Optional[Tuple[bytes, str]]:
+        task = self._inflight.get(api_url)
+        if task is None:
+            task = asyncio.create_task(self._fetch_one(session, api_url))
+            self._inflight[api_url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(api_url, None))
+        return await asyncio.shield(task)
+
+    # 抽取核心的下载流程，专门用于多次调用；所有 API 并发请求，取最先成功的一张
+    async def _download_image(self, session: aiohttp.ClientSession, source: _CompiledSource) -> Tuple[bytes, str]:
+        # 跳过熔断中的 API；全部处于熔断时直接失败，不再发起请求
+        now = time.monotonic()
+        candidates = []
+        for url in source.apis:
+            fails, open_until = self._breaker.get(url, (0, 0.0))
+            if open_until > now: continue
+            if fails >= self._BREAKER_THRESHOLD:
+                # 熔断期已过：放行这一次试探请求并立即重新计时，同一窗口内其他请求继续跳过
+                self._breaker[url] = (fails, now + self._BREAKER_COOLDOWN)
+            candidates.append(url)
+        if not candidates: return None, None
+        fetch = self._fetch_shared if source.coalesce else self._fetch_one
+        tasks = [asyncio.create_task(fetch(session, url)) for url in candidates]
+        result = None
+        try:
+            for fut in asyncio.as_completed(tasks):
+                result = await fut
+                if result: break
+        finally:
+            for task in tasks: task.cancel()
+
+        if not result: return None, None
+        return result
+
+    async def _write_temp(self, body: bytes) -> str:
+        file_ext = self._sniff_ext(body) or "jpg"
+
+        filename = f"{self._file_prefix}-{next(self._file_counter)}.{file_ext}"
+        temp_file_path = os.path.join(self.cache_dir, filename)
+
+        async with aiofiles.open(temp_file_path, "wb") as f:
+            await f.write(body)
+
+        return temp_file_path
+
+    # 默认以 base64 在内存中直接发送；个别协议端不支持时可开启 send_via_file 落盘发送。
+    # 临时文件写入失败时返回 None，由调用方视为本次获取失败
+    async def _build_image(self, body: bytes) -> Optional[Tuple[dict, Image, Optional[str]]]:
+        if self.cfg.get("send_via_file", False):
+            try: path = await self._write_temp(body)
             except Exception as e:
-                logger.error(f"[随机图片] 处理图源时出现异常: {e}")
-                continue
-        return None, None
+                logger.error(f"[随机图片] 写入临时图片失败: {e}")
+                return None
+            return {'type': 'image', 'data': {'file': Path(path).absolute().as_uri()}}, Image.fromFileSystem(path), path
+        b64 = base64.b64encode(body).decode()
+        return {'type': 'image', 'data': {'file': f"base64://{b64}"}}, Image.fromBase64(b64), None
+
+    async def _remove_file(self, path: str):
+        try: await aiofiles.os.remove(path)
+        except FileNotFoundError: pass
+        except OSError as e: logger.warning(f"[随机图片] 删除临时文件失败: {e}")
 
     async def _delayed_delete(self, path: str):
-        await asyncio.sleep(30)
-        try: os.remove(path)
-        except: pass
+        try: await asyncio.sleep(30)
+        finally: await self._remove_file(path)
 
-    async def _process_and_send(self, event: AstrMessageEvent, api_list: List[str], source_cfg: dict, count: int, use_forward: bool) -> bool:
-        ssl_context = aiohttp.TCPConnector(verify_ssl=self.cfg.get("verify_ssl", True))
+    def _schedule_delete(self, path: str):
+        task = asyncio.create_task(self._delayed_delete(path))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _process_and_send(self, event: AstrMessageEvent, source: _CompiledSource, count: int, use_forward: bool) -> bool:
         max_retries = self.cfg.get("send_retries", 3)
-        recall_delay = int(source_cfg.get("recall_delay", 0)) if source_cfg.get("recall_delay") else 0
+        recall_delay = source.recall_delay
         
         success_count = 0
         last_final_url = ""
         rets_to_recall = []
 
-        async with aiohttp.ClientSession(connector=ssl_context) as session:
-            # ================= 模式一：批量且合并转发 =================
-            if use_forward:
-                temp_files = []
-                urls = []
-                for _ in range(count):
-                    # 即使是合并转发，获取图片阶段也允许网络重试
-                    for _ in range(max_retries + 1):
-                        path, url = await self._download_image(session, api_list)
-                        if path:
-                            temp_files.append(path)
-                            urls.append(url)
-                            break
-                
-                if not temp_files:
-                    await event.send(MessageChain([Plain(self._text("所有图源均无法连接，或已被屏蔽"))]))
-                    return False
-                
-                last_final_url = urls[-1] if urls else ""
-                
-                # 将收集到的多张图片打包在一个合并转发节点内
-                obmsg_batch = []
-                fallback_chains = []
-                for path in temp_files:
-                    file_uri = Path(path).absolute().as_uri()
-                    obmsg_batch.append({'type': 'image', 'data': {'file': file_uri}})
-                    fallback_chains.append(Image.fromFileSystem(path))
-                
-                fallback_chain = MessageChain(fallback_chains)
-                
-                try:
-                    send_ret = await self._send_advanced(event, obmsg_batch, fallback_chain, use_forward=True)
-                    if send_ret:
-                        success_count = len(temp_files)
-                        if recall_delay > 0: rets_to_recall.append(send_ret)
+        session = await self._get_session()
+        # ================= 模式一：批量且合并转发 =================
+        if use_forward:
+            images = []
+            urls = []
+            for _ in range(count):
+                # 即使是合并转发，获取图片阶段也允许网络重试；API 全部熔断时不再重试
+                for attempt in range(max_retries + 1):
+                    body, url = await self._download_image(session, source)
+                    if body:
+                        images.append(body)
+                        urls.append(url)
+                        break
+                    if not self._has_available_api(source): break
+                    if attempt < max_retries: await self._backoff(attempt)
+                if not self._has_available_api(source): break
+            
+            if not images:
+                await event.send(MessageChain([Plain(self._text("所有图源均无法连接，或已被屏蔽"))]))
+                return False
+            
+            last_final_url = urls[-1] if urls else ""
+            
+            # 将收集到的多张图片打包在一个合并转发节点内
+            obmsg_batch = []
+            fallback_chains = []
+            for body in images:
+                built = await self._build_image(body)
+                if not built: continue
+                segment, component, path = built
+                obmsg_batch.append(segment)
+                fallback_chains.append(component)
+                # 无论发送成功与否都要清理，直链兜底分支会提前返回
+                if path: self._schedule_delete(path)
+
+            if not obmsg_batch:
+                await event.send(MessageChain([Plain(self._text("所有图源均无法连接，或已被屏蔽"))]))
+                return False
+            
+            fallback_chain = MessageChain(fallback_chains)
+            
+            try:
+                send_ret = await self._send_advanced(event, obmsg_batch, fallback_chain, use_forward=True)
+                if send_ret:
+                    success_count = len(obmsg_batch)
+                    if recall_delay > 0: rets_to_recall.append(send_ret)
+                else:
+                    raise Exception("Send advanced failed")
+            except Exception as e:
+                logger.warning(f"[随机图片] 合并转发调用失败，触发直链兜底: {e}")
+                fallback_msg = self._text(f"图片批量发送均被拦截，为您提供最后一张图的直链：\n{last_final_url}")
+                await self._send_advanced(event, [{'type': 'text', 'data': {'text': fallback_msg}}], MessageChain([Plain(fallback_msg)]), use_forward=True)
+                return True 
+
+        # ================= 模式二：直发模式（带有重新抽卡防拦截） =================
+        else:
+            for _ in range(count):
+                send_success = False
+                for attempt in range(max_retries + 1):
+                    body, url = await self._download_image(session, source)
+                    if not body:
+                        # API 全部熔断时不再重试；否则退避后重新抽卡
+                        if not self._has_available_api(source): break
+                        if attempt < max_retries: await self._backoff(attempt)
+                        continue
+                    last_final_url = url
+                    
+                    built = await self._build_image(body)
+                    if not built:
+                        if attempt < max_retries: await self._backoff(attempt)
+                        continue
+                    segment, component, path = built
+                    obmsg_img = [segment]
+                    fallback_chain_img = MessageChain([component])
+                    
+                    try:
+                        # 尝试单独发送该图片
+                        send_ret = await self._send_advanced(event, obmsg_img, fallback_chain_img, use_forward=False)
+                        if send_ret: 
+                            send_success = True
+                            success_count += 1
+                            if recall_delay > 0: rets_to_recall.append(send_ret)
+                            if path: self._schedule_delete(path)
+                            break 
+                    except Exception as e:
+                        logger.warning(f"[随机图片] 第 {attempt+1} 次获取的图片被拦截或发送失败，准备重新抽卡获取新图: {e}")
+                        if path: await self._remove_file(path)
+                        if attempt < max_retries: await self._backoff(attempt)
                     else:
-                        raise Exception("Send advanced failed")
-                except Exception as e:
-                    logger.warning(f"[随机图片] 合并转发调用失败，触发直链兜底: {e}")
-                    fallback_msg = self._text(f"图片批量发送均被拦截，为您提供最后一张图的直链：\n{last_final_url}")
+                        # 未抛异常但也未确认发送成功（如 event.send 返回 None），同样清理临时文件
+                        if path: await self._remove_file(path)
+
+                if not send_success:
+                    if not self._has_available_api(source):
+                        logger.warning(f"[随机图片] 图源 [{source.name}] 的 API 均处于熔断中，本次请求已停止")
+                        break
+                    logger.error(f"[随机图片] 一张图片连续 {max_retries + 1} 次被拦截，已放弃该张")
+                    
+            # 如果一张都没发出来，触发兜底
+            if success_count == 0:
+                if last_final_url:
+                    fallback_msg = self._text(f"图片多次发送均被拦截（已尝试重新抽卡），为您提供最后一张图的直链：\n{last_final_url}")
                     await self._send_advanced(event, [{'type': 'text', 'data': {'text': fallback_msg}}], MessageChain([Plain(fallback_msg)]), use_forward=True)
-                    return True 
-                
-                for path in temp_files:
-                    asyncio.create_task(self._delayed_delete(path))
-
-            # ================= 模式二：直发模式（带有重新抽卡防拦截） =================
-            else:
-                for _ in range(count):
-                    send_success = False
-                    for attempt in range(max_retries + 1):
-                        path, url = await self._download_image(session, api_list)
-                        if not path: continue
-                        last_final_url = url
-                        
-                        file_uri = Path(path).absolute().as_uri()
-                        obmsg_img = [{'type': 'image', 'data': {'file': file_uri}}]
-                        fallback_chain_img = MessageChain([Image.fromFileSystem(path)])
-                        
-                        try:
-                            # 尝试单独发送该图片
-                            send_ret = await self._send_advanced(event, obmsg_img, fallback_chain_img, use_forward=False)
-                            if send_ret: 
-                                send_success = True
-                                success_count += 1
-                                if recall_delay > 0: rets_to_recall.append(send_ret)
-                                asyncio.create_task(self._delayed_delete(path))
-                                break 
-                        except Exception as e:
-                            logger.warning(f"[随机图片] 第 {attempt+1} 次获取的图片被拦截或发送失败，准备重新抽卡获取新图: {e}")
-                            try: os.remove(path)
-                            except: pass
-                            await asyncio.sleep(1) 
-
-                    if not send_success:
-                        logger.error(f"[随机图片] 一张图片连续 {max_retries + 1} 次被拦截，已放弃该张")
-                        
-                # 如果一张都没发出来，触发兜底
-                if success_count == 0:
-                    if last_final_url:
-                        fallback_msg = self._text(f"图片多次发送均被拦截（已尝试重新抽卡），为您提供最后一张图的直链：\n{last_final_url}")
-                        await self._send_advanced(event, [{'type': 'text', 'data': {'text': fallback_msg}}], MessageChain([Plain(fallback_msg)]), use_forward=True)
-                        return True
-                    else:
-                        await event.send(MessageChain([Plain(self._text("所有图源均无法连接，或已被屏蔽"))]))
-                    return False
+                    return True
+                else:
+                    await event.send(MessageChain([Plain(self._text("所有图源均无法连接，或已被屏蔽"))]))
+                return False
 
         # 处理独立的撤回提醒消息
         if success_count > 0 and recall_delay > 0: